@@ -5,11 +5,26 @@ apwgen.py
 A phoneme-based passphrase generator inspired by the Apple Passwords app.
 '''
 import argparse
+import bisect
 import secrets
 import sys
 import os
 import math
 import textwrap
+import itertools
+import asyncio
+import collections
+import base64
+import hashlib
+import queue
+import threading
+import multiprocessing
+import json
+import mmap
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
 from types import SimpleNamespace
 from importlib.metadata import version, PackageNotFoundError
 
@@ -41,93 +56,439 @@ SYLLABLE_STRUCTURES = (
 assert len(SYLLABLE_PATTERNS) == len(SYLLABLE_STRUCTURES), \
         "SYLLABLE_PATTERNS and SYLLABLE_STRUCTURES must have the same length"
 
+''' Upper bound for the number of entries of a single precomputed syllable
+    table (see syllable_tables()). Patterns exceeding it fall back to
+    drawing each character separately.
+'''
+SYLLABLE_TABLE_MAX_ENTRIES = 1 << 16
+
+''' Number of (vowels, consonants) pairs whose syllable tables are kept. '''
+SYLLABLE_TABLE_CACHE_SIZE = 4
+
+''' Number of option combinations whose entropy tables are kept
+    (see entropy_bits()).
+'''
+ENTROPY_TABLE_CACHE_SIZE = 8
+
+''' Number of passphrases generated at once by iter_passphrases() and
+    aiter_passphrases().
+'''
+PASSPHRASE_CHUNK_SIZE = 64
+
+''' Default parameters of the key derivation functions supported by
+    provision_passphrases().
+'''
+KDF_DEFAULTS = {
+        'scrypt': {'n': 1 << 14, 'r': 8, 'p': 1, 'dklen': 32},
+        'pbkdf2': {'hash_name': 'sha256', 'iterations': 600000, 'dklen': 32},
+    }
+
+''' Layout of files written by export_passphrases(): a header (magic,
+    header size, record size, number of records) followed by JSON metadata,
+    padded to a multiple of 8 bytes. Then one fixed size record per
+    passphrase: its length in bytes, followed by the UTF-8 encoded
+    passphrase padded with zero bytes.
+'''
+EXPORT_MAGIC = b'APWGEN\x00\x01'
+EXPORT_HEADER = struct.Struct('<8sIIQ')
+EXPORT_RECORD_PREFIX = struct.Struct('<H')
+
+''' Phonotactic classes of the default consonants (h, j, q and x are left out
+    and only form the clusters listed explicitly), used to build the consonant
+    clusters allowed by the phoneme transition model (--markov).
+'''
+STOPS = 'bcdgkpt'
+FRICATIVES = 'fsvz'
+NASALS = 'mn'
+LIQUIDS = 'rw'  # liquid and glide
+
+CONSONANT_CLUSTERS = frozenset(
+        [a + b for a in 'r' for b in STOPS + FRICATIVES + NASALS]
+        + [a + b for a in NASALS for b in STOPS + FRICATIVES]
+        + [a + b for a in STOPS for b in LIQUIDS]
+        + [a + b for a in 'ckp' for b in 'st']
+        + [a + b for a in 's' for b in 'ckmnptw']
+        + [a + b for a in 'bdfgmnprstz' for b in a]
+        + ['ch', 'fr', 'ft', 'gh', 'hm', 'hn', 'ht', 'mn', 'nj', 'nq', 'ph',
+           'sh', 'th', 'vr', 'wh', 'xc', 'xp', 'xt'])
+
+''' Bigram weights for the phoneme transition model. They apply between
+    consecutive characters of a word, including across syllable boundaries.
+    Two consonants must form one of the CONSONANT_CLUSTERS; all other bigrams
+    not listed have a weight of 1. A weight of 0 forbids the bigram.
+'''
+BIGRAM_WEIGHTS = dict(
+        [(pair, 1) for pair in CONSONANT_CLUSTERS]
+        + [(pair, 0) for pair in ('ii', 'iy', 'uu', 'yi', 'yy')]
+        + [(pair, 2) for pair in ('mb', 'mp', 'nd', 'ng', 'nk', 'nt', 'rk',
+                                  'rm', 'rn', 'rt', 'sk', 'sp', 'st')])
+
 try:
     __version__ = version("apwgen")
 except PackageNotFoundError:
     __version__ = None
 
 
+def syllable_type_weights():
+    '''
+    Return the integer weight of each syllable type under weighted_random(n):
+    type k is picked when int(sqrt(r)) == n-1-k, which covers (2*(n-1-k)+1)
+    of the n*n values of r.
+    '''
+    n = len(SYLLABLE_PATTERNS)
+    return [2 * (n - 1 - k) + 1 for k in range(n)]
+
+
+def syllable_type_probabilities():
+    '''
+    Return the probability of each syllable type under weighted_random(n).
+    '''
+    n = len(SYLLABLE_PATTERNS)
+    return [w / (n * n) for w in syllable_type_weights()]
+
+
+def syllable_length_classes():
+    '''
+    Return a (length, weight, types) triple for each distinct syllable
+    length, in ascending order: the syllable types of that length and the sum
+    of their syllable_type_weights().
+    '''
+    weights = syllable_type_weights()
+    classes = {}
+    for syllable_type, (nc, nv) in enumerate(SYLLABLE_STRUCTURES):
+        classes.setdefault(nc + nv, []).append(syllable_type)
+    return [(length, sum(weights[t] for t in types), types)
+            for length, types in sorted(classes.items())]
+
+
+@lru_cache(maxsize=SYLLABLE_TABLE_CACHE_SIZE)
+def syllable_length_table(num_syllables):
+    '''
+    Return the cumulative counts of syllable type sequences of num_syllables
+    syllables by length: entry x is the weighted number of sequences with
+    fewer than x characters, using syllable_type_weights(), so the last
+    entry is (n*n)**num_syllables.
+    The number of sequences with a length in [a, b] is row[b + 1] - row[a].
+    '''
+    classes = syllable_length_classes()
+    counts = [1]
+    for _ in range(num_syllables):
+        new = [0] * (len(counts) + classes[-1][0])
+        for l1, c in enumerate(counts):
+            if c:
+                for l2, w, _ in classes:
+                    new[l1 + l2] += c * w
+        counts = new
+    cumulative = [0]
+    for c in counts:
+        cumulative.append(cumulative[-1] + c)
+    return tuple(cumulative)
+
+
+def _class_count(n, x, classes):
+    '''
+    Return the weighted number of sequences of n syllables with x characters
+    in total, drawn from the (length, weight, types) classes of
+    syllable_length_classes().
+    '''
+    (length, weight, _), rest = classes[0], classes[1:]
+    if not rest:
+        return weight ** n if x == n * length else 0
+    if len(rest) == 1:
+        # a syllables of the first class and n - a of the second one
+        length2, weight2, _ = rest[0]
+        a, r = divmod(n * length2 - x, length2 - length)
+        if r or not 0 <= a <= n:
+            return 0
+        return math.comb(n, a) * weight ** a * weight2 ** (n - a)
+    return sum(_class_counts(n, x, classes))
+
+
+def _class_counts(n, x, classes):
+    '''
+    Return a list holding _class_count(n, x, classes) split up by the number
+    a in 0..n of syllables of the first class.
+    '''
+    (length, weight, _), rest = classes[0], classes[1:]
+    if not rest:
+        return [0] * n + [_class_count(n, x, classes)]
+    counts = []
+    for a in range(n + 1):
+        count = _class_count(n - a, x - a * length, rest)
+        counts.append(count and math.comb(n, a) * weight ** a * count)
+    return counts
+
+
+def _weighted_index(weights):
+    '''
+    Return an index into the list of integer weights, drawn with
+    probability proportional to its weight.
+    '''
+    r = secrets.randbelow(sum(weights))
+    for i, w in enumerate(weights):
+        if r < w:
+            break
+        r -= w
+    return i
+
+
+def _count_in_range(table, lo, hi):
+    '''
+    Return the number of sequences counted by a syllable_length_table() with
+    a length in [lo, hi].
+    '''
+    lo = max(lo, 0)
+    hi = min(hi, len(table) - 2)
+    if lo > hi:
+        return 0
+    return table[hi + 1] - table[lo]
+
+
+def _delimiter_count(options):
+    return (options.words - 1) if len(options.delimiters) > 0 else 0
+
+
+def _length_bounds(options):
+    '''
+    Return the (minimum, maximum) passphrase length requested with
+    --length, --max-length and --exact-length, or None if unconstrained.
+    '''
+    exact_length = getattr(options, 'exact_length', None)
+    max_length = getattr(options, 'max_length', None)
+    if exact_length is not None:
+        return exact_length, exact_length
+    if options.length is None and max_length is None:
+        return None
+    return (options.length if options.length is not None else 0,
+            max_length if max_length is not None else math.inf)
+
+
 def _passphrase_length_pmf(options):
     '''
     Return the probability mass function of passphrase length (words + delimiters),
-    before digit/uppercase substitutions (which don't change length).
+    before digit/uppercase substitutions (which don't change length). This is
+    the probability mass of _passphrase_entropy_table(), so lengths and
+    entropy_bits() come from the same convolution.
     '''
-    n = len(SYLLABLE_PATTERNS)
-    probs = [(2 * (n - 1 - k) + 1) / (n * n) for k in range(n)]
-    syl_pmf = {}
-    for p, (nc_t, nv_t) in zip(probs, SYLLABLE_STRUCTURES):
-        length = nc_t + nv_t
-        syl_pmf[length] = syl_pmf.get(length, 0.0) + p
-
-    pmf = {0: 1.0}
-    for _ in range(options.words * options.syllables):
-        new = {}
-        for l1, p1 in pmf.items():
-            for l2, p2 in syl_pmf.items():
-                key = l1 + l2
-                new[key] = new.get(key, 0.0) + p1 * p2
-        pmf = new
-
-    delimiter_len = (options.words - 1) if len(options.delimiters) > 0 else 0
-    if delimiter_len > 0:
-        pmf = {length + delimiter_len: p for length, p in pmf.items()}
-    return pmf
+    table = _passphrase_entropy_table(
+            options.words, options.syllables, options.vowels,
+            options.consonants, getattr(options, 'markov', False))
+    delimiter_len = _delimiter_count(options)
+    return {length + delimiter_len: masses[0]
+            for length, masses in enumerate(table) if masses[0] > 0}
 
 
 def entropy_bits(options):
     '''
     Estimate the entropy in bits of a passphrase generated with the given options.
     Accounts for the non-uniform syllable type distribution of weighted_random()
-    and the rejection sampling effect of --length.
+    and conditions exactly on --length, --max-length and --exact-length, see
+    _passphrase_entropy_table(). Digit and uppercase placement, less the
+    letters replaced by digits, is computed by _placement_entropy(). The
+    estimate is the entropy of the passphrase together with its syllable
+    types.
     '''
-    n = len(SYLLABLE_PATTERNS)
-    # probability of each syllable type under weighted_random(n):
-    # type k is picked when int(sqrt(r)) == n-1-k, which covers (2*(n-1-k)+1) values of r
-    probs = [(2 * (n - 1 - k) + 1) / (n * n) for k in range(n)]
-    nc = len(options.consonants)
-    nv = len(options.vowels)
-
-    h_type = -sum(p * math.log2(p) for p in probs)
-    h_chars = sum(
-            p * (nc_t * math.log2(nc) + nv_t * math.log2(nv))
-            for p, (nc_t, nv_t) in zip(probs, SYLLABLE_STRUCTURES))
-    h_words = options.words * options.syllables * (h_type + h_chars)
-
-    if options.num_digits > 0:
-        if options.allnums:
-            avg_syl_len = sum(p * (nc_t + nv_t)
-                              for p, (nc_t, nv_t) in zip(probs, SYLLABLE_STRUCTURES))
-            num_pos = int(options.words * options.syllables * avg_syl_len)
-        else:
-            num_pos = 2 * options.words - 1
-        h_digits = sum(
-                math.log2(num_pos - i) + math.log2(len(options.numerics))
-                for i in range(min(options.num_digits, num_pos)))
-    else:
-        h_digits = 0.0
-
-    if options.upper > 0:
-        avg_syl_len = sum(p * (nc_t + nv_t)
-                          for p, (nc_t, nv_t) in zip(probs, SYLLABLE_STRUCTURES))
-        avg_lc = options.words * options.syllables * avg_syl_len - options.num_digits
-        h_upper = sum(math.log2(avg_lc - i)
-                      for i in range(min(options.upper, int(avg_lc))))
-    else:
-        h_upper = 0.0
+    # Length constraints condition the distribution on lo <= len <= hi. Given a
+    # passphrase x of an allowed length, P(x | A) = P(x) / P(A), so its entropy
+    # is log2(P(A)) + E[-log2(P(x)) | A], with the expectation taken from the
+    # probability and entropy masses per length.
+    bounds = _length_bounds(options) or (0, math.inf)
+    lo = max(bounds[0] - _delimiter_count(options), 0)
+    hi = bounds[1] - _delimiter_count(options)
+    markov = getattr(options, 'markov', False)
+    table = _passphrase_entropy_table(
+            options.words, options.syllables, options.vowels,
+            options.consonants, markov)
+    allowed = range(lo, min(hi, len(table) - 1) + 1)
+    p_accept = sum(table[length][0] for length in allowed)
+    if p_accept <= 0:
+        return -math.inf
+    h_words = (math.log2(p_accept)
+               + sum(table[length][1] for length in allowed) / p_accept)
+
+    h_placement = _placement_entropy(
+            options.words, options.syllables, options.vowels,
+            options.consonants, markov, options.num_digits, options.upper,
+            len(options.numerics), options.allnums, lo, hi)
 
     h_delimiters = (options.words - 1) * math.log2(max(1, len(options.delimiters)))
 
-    # --length applies rejection sampling: passphrases shorter than the threshold
-    # are discarded. This conditions the distribution on len >= L, reducing entropy
-    # by log2(P(len >= L)).
-    if options.length is not None:
-        pmf = _passphrase_length_pmf(options)
-        p_accept = sum(p for length, p in pmf.items() if length >= options.length)
-        h_length = math.log2(p_accept) if p_accept > 0 else -math.inf
-    else:
-        h_length = 0.0
+    return h_words + h_placement + h_delimiters
+
+
+def _log2_binomial(n, k):
+    return (math.lgamma(n + 1) - math.lgamma(k + 1)
+            - math.lgamma(n - k + 1)) / math.log(2)
 
-    return h_words + h_digits + h_upper + h_delimiters + h_length
+
+@lru_cache(maxsize=ENTROPY_TABLE_CACHE_SIZE)
+def _placement_entropy(num_words, num_syllables, vowels, consonants, markov,
+                       num_digits, upper, num_numerics, allnums, lo, hi):
+    '''
+    Return the exact entropy in bits added by the digit and uppercase
+    placement. For a passphrase with L letters, d = min(num_digits, D) digits
+    go to a uniformly chosen set of the D eligible positions (L with allnums,
+    otherwise 2 * num_words - 1) and u = min(upper, L - d) uppercase letters
+    to a set of the remaining L - d letters, contributing
+    log2(C(D, d)) + d * log2(num_numerics) + log2(C(L - d, u)) bits.
+    The letters replaced by digits are no longer part of the passphrase, so
+    each eligible position loses the entropy of its letter with probability
+    d / D. Everything is averaged over the letter counts and letter entropies
+    of _passphrase_entropy_table(), conditioned on lo <= L <= hi.
+    With markov, a replaced letter loses its entropy given its predecessor,
+    which may overstate what its other neighbours don't reveal, so the
+    result errs on the low side.
+    '''
+    table = _passphrase_entropy_table(num_words, num_syllables, vowels,
+                                      consonants, markov)
+    h = 0.0
+    p_total = 0.0
+    for letters in range(max(lo, 0), min(hi, len(table) - 1) + 1):
+        p, _, h_chars, h_boundary = table[letters]
+        if p == 0:
+            continue
+        eligible = letters if allnums else 2 * num_words - 1
+        digits = min(num_digits, eligible)
+        lowercase = letters - digits
+        h_letters = (_log2_binomial(eligible, digits)
+                     + _log2_binomial(lowercase, min(upper, lowercase)))
+        if digits > 0:
+            h_letters += digits * math.log2(num_numerics)
+            h_eligible = h_chars if allnums else h_boundary
+            h_letters -= digits / eligible * h_eligible / p
+        h += p * h_letters
+        p_total += p
+    return h / p_total if p_total > 0 else 0.0
+
+
+def _branch(masses, w, deltas):
+    '''
+    Return the masses of a branch of probability w, where the additive
+    quantities grow by deltas: (p * w, (q + p * delta) * w, ...).
+    '''
+    p = masses[0]
+    return [p * w] + [(q + p * d) * w for q, d in zip(masses[1:], deltas)]
+
+
+def _accumulate(acc, masses):
+    for i, q in enumerate(masses):
+        acc[i] += q
+
+
+@lru_cache(maxsize=ENTROPY_TABLE_CACHE_SIZE)
+def _word_entropy_table(num_syllables, vowels, consonants, markov):
+    '''
+    Return a tuple indexed by the number of letters of a single word, holding
+    the masses (probability, entropy, character entropy, first letter
+    entropy, last letter entropy) per length. Each mass besides the
+    probability is the sum of P(t) times a quantity over the syllable type
+    sequences t of that length: -log2(P(t)) + H(characters | t) for the
+    entropy mass, H(characters | t) alone, and the entropy of the first
+    and of the last letter. Without markov, this is the convolution of
+    the syllable type weights with these quantities carried along.
+    With markov, the joint distribution of the previous character and the
+    class the next syllable starts with is propagated through the syllables,
+    as the transition tables depend on both.
+    '''
+    probs = syllable_type_probabilities()
+    templates = [syllable_template(t) for t in range(len(SYLLABLE_PATTERNS))]
+    last = num_syllables - 1
+    if not markov:
+        bits = {'v': math.log2(len(vowels)), 'c': math.log2(len(consonants))}
+        table = [(1.0, 0.0, 0.0, 0.0, 0.0)]
+        for i in range(num_syllables):
+            new = [[0.0] * 5 for _ in range(len(table) + max(map(len, templates)))]
+            for l1, masses in enumerate(table):
+                if masses[0] == 0:
+                    continue
+                for p, template in zip(probs, templates):
+                    h_chars = sum(bits[c] for c in template)
+                    _accumulate(new[l1 + len(template)], _branch(masses, p, (
+                            -math.log2(p) + h_chars, h_chars,
+                            bits[template[0]] if i == 0 else 0.0,
+                            bits[template[-1]] if i == last else 0.0)))
+            table = new
+        return tuple(map(tuple, table))
+
+    transitions = transition_tables(vowels, consonants)
+    pmfs = {}
+    for prev, by_class in transitions.items():
+        for key, chars in by_class.items():
+            pmf = {}
+            for ch in chars:
+                pmf[ch] = pmf.get(ch, 0.0) + 1 / len(chars)
+            pmfs[(prev,) + key] = (
+                    pmf, -sum(p * math.log2(p) for p in pmf.values()))
+    p_first = {}
+    for p, template in zip(probs, templates):
+        p_first[template[0]] = p_first.get(template[0], 0.0) + p
+
+    # (previous character, class the next syllable starts with, length)
+    #   -> masses
+    state = {(None, None, 0): (1.0, 0.0, 0.0, 0.0, 0.0)}
+    for i in range(num_syllables):
+        follows = [(None, 1.0)] if i == last else list(p_first.items())
+        new_state = {}
+        for (prev, first, length), masses in state.items():
+            for p, template in zip(probs, templates):
+                if first is not None:
+                    if template[0] != first:
+                        continue
+                    p /= p_first[first]
+                for follow, r in follows:
+                    w = p * r
+                    classes = template + (follow or '')
+                    dist = {prev: _branch(masses, w, (-math.log2(w), 0.0, 0.0, 0.0))}
+                    for j, cls in enumerate(template):
+                        nxt = classes[j + 1] if j + 1 < len(classes) else None
+                        new_dist = {}
+                        for ch, char_masses in dist.items():
+                            pmf, h_next = pmfs[ch, cls, nxt]
+                            deltas = (h_next, h_next,
+                                      h_next if i == 0 and j == 0 else 0.0,
+                                      h_next if i == last and j == len(template) - 1
+                                      else 0.0)
+                            for ch2, x in pmf.items():
+                                _accumulate(new_dist.setdefault(ch2, [0.0] * 5),
+                                            _branch(char_masses, x, deltas))
+                        dist = new_dist
+                    for ch, char_masses in dist.items():
+                        _accumulate(new_state.setdefault(
+                                (ch, follow, length + len(template)), [0.0] * 5),
+                                    char_masses)
+        state = new_state
+
+    table = [[0.0] * 5 for _ in range(max(map(len, templates)) * num_syllables + 1)]
+    for (_, _, length), masses in state.items():
+        _accumulate(table[length], masses)
+    return tuple(map(tuple, table))
+
+
+@lru_cache(maxsize=ENTROPY_TABLE_CACHE_SIZE)
+def _passphrase_entropy_table(num_words, num_syllables, vowels, consonants,
+                              markov):
+    '''
+    Return a tuple indexed by the number of letters of a passphrase, holding
+    the masses (probability, entropy, character entropy, boundary letter
+    entropy) per length like _word_entropy_table(), for all words together.
+    Boundary letters are those eligible for digits without --allnums: the
+    last letter of the first word and the first and last letter of the
+    other words.
+    '''
+    word = _word_entropy_table(num_syllables, vowels, consonants, markov)
+    table = [(1.0, 0.0, 0.0, 0.0)]
+    for i in range(num_words):
+        new = [[0.0] * 4 for _ in range(len(table) + len(word) - 1)]
+        for l1, (m1, e1, c1, b1) in enumerate(table):
+            if m1 == 0:
+                continue
+            for l2, (m2, e2, c2, f2, b2) in enumerate(word):
+                if i > 0:
+                    b2 += f2
+                _accumulate(new[l1 + l2], (m1 * m2, e1 * m2 + e2 * m1,
+                                           c1 * m2 + c2 * m1, b1 * m2 + b2 * m1))
+        table = new
+    return tuple(map(tuple, table))
 
 
 def weighted_random(n):
@@ -138,36 +499,188 @@ def weighted_random(n):
     return (n - 1) - int(math.sqrt(r))
 
 
-def generate_syllable(syllable_type, vowels, consonants):
+def generate_syllable_types(options):
     '''
-    Generate a syllable
+    Draw the syllable types of all words, conditioned on the length
+    constraints of the options. Unless every reachable length is allowed,
+    the number of characters is drawn first, from the counts of
+    syllable_length_table(), then how many syllables have each length, then
+    their order and finally the type of each syllable given its length. This
+    yields the same distribution as rejecting passphrases of the wrong length.
+    Return a list with a list of syllable types per word.
+    '''
+    num_syllables = options.words * options.syllables
+    lo, hi = _length_bounds(options) or (0, math.inf)
+    lo -= _delimiter_count(options)
+    hi -= _delimiter_count(options)
+    classes = syllable_length_classes()
+
+    if (lo <= num_syllables * classes[0][0]
+            and hi >= num_syllables * classes[-1][0]):
+        types = [weighted_random(len(SYLLABLE_PATTERNS))
+                 for _ in range(num_syllables)]
+    else:
+        table = syllable_length_table(num_syllables)
+        total = _count_in_range(table, lo, hi)
+        if total == 0:
+            raise ValueError('No passphrase can satisfy the specified length constraints.')
+        length = bisect.bisect_right(
+                table, table[max(lo, 0)] + secrets.randbelow(total)) - 1
+
+        length_classes = []
+        remaining = num_syllables
+        for i, (class_length, _, _) in enumerate(classes):
+            a = _weighted_index(_class_counts(remaining, length, classes[i:]))
+            length_classes += [i] * a
+            remaining -= a
+            length -= a * class_length
+        for i in range(len(length_classes) - 1, 0, -1):
+            j = secrets.randbelow(i + 1)
+            length_classes[i], length_classes[j] = length_classes[j], length_classes[i]
+
+        weights = syllable_type_weights()
+        types = []
+        for i in length_classes:
+            class_types = classes[i][2]
+            types.append(class_types[_weighted_index([weights[t] for t in class_types])])
+    return [types[i:i + options.syllables]
+            for i in range(0, num_syllables, options.syllables)]
+
+
+def syllable_template(syllable_type):
+    '''
+    Return the character classes of a syllable pattern as a string,
+    e.g. 'cvc' for a consonant-vowel-consonant syllable.
+    '''
+    return SYLLABLE_PATTERNS[syllable_type](lambda: 'v', lambda: 'c')
+
+
+@lru_cache(maxsize=SYLLABLE_TABLE_CACHE_SIZE)
+def syllable_tables(vowels, consonants):
     '''
+    Return a tuple with one table per syllable pattern, holding every syllable
+    the pattern can produce from the given pools. Tables are cached for the
+    SYLLABLE_TABLE_CACHE_SIZE most recently used (vowels, consonants) pairs.
+    Tables that would exceed
+    SYLLABLE_TABLE_MAX_ENTRIES are replaced by None.
+
+    Duplicate characters within a pool are enumerated once per occurrence, so
+    a uniform pick from a table has exactly the same distribution as drawing
+    every character separately.
+    '''
+    pools = {'v': vowels, 'c': consonants}
+    tables = []
+    for syllable_type in range(len(SYLLABLE_PATTERNS)):
+        template = syllable_template(syllable_type)
+        size = 1
+        for t in template:
+            size *= len(pools[t])
+        if size == 0 or size > SYLLABLE_TABLE_MAX_ENTRIES:
+            tables.append(None)
+            continue
+        tables.append(tuple(''.join(chars) for chars in
+                            itertools.product(*(pools[t] for t in template))))
+    return tuple(tables)
+
+
+@lru_cache(maxsize=SYLLABLE_TABLE_CACHE_SIZE)
+def transition_tables(vowels, consonants):
+    '''
+    Return the phoneme transition tables for the given pools as a dictionary
+    mapping the previous character (None at the start of a word) to a
+    dictionary of tables. They are keyed by the class of the character to
+    draw ('v' or 'c') and the class of the character following it (None at
+    the end of a word), so no character is drawn that cannot be followed by
+    the next one.
+    Each table holds the candidate characters repeated by their weight, see
+    BIGRAM_WEIGHTS, so a weighted draw is a single randbelow() and a lookup.
+    When every candidate is forbidden, the next character is not taken into
+    account, and if that doesn't help either, all candidates are allowed
+    with equal weight.
+    '''
+    pools = {'v': vowels, 'c': consonants}
+
+    def weight(prev, ch, cls):
+        if prev is None:
+            return 1
+        default = 0 if cls == 'c' and prev in consonants else 1
+        return BIGRAM_WEIGHTS.get(prev + ch, default)
+
+    followed = {(ch, cls): any(weight(ch, nxt, cls) for nxt in pools[cls])
+                for ch in set(vowels + consonants) for cls in pools}
+    result = {}
+    for prev in (None,) + tuple(set(vowels + consonants)):
+        result[prev] = {}
+        for cls, pool in pools.items():
+            weights = [weight(prev, ch, cls) for ch in pool]
+            unconstrained = tuple(ch for ch, w in zip(pool, weights)
+                                  for _ in range(w)) or tuple(pool)
+            result[prev][cls, None] = unconstrained
+            for follow in pools:
+                table = tuple(ch for ch, w in zip(pool, weights)
+                              if followed[ch, follow] for _ in range(w))
+                result[prev][cls, follow] = table or unconstrained
+    return result
+
+
+def generate_syllable(syllable_type, vowels, consonants, tables=False):
+    '''
+    Generate a syllable. With tables=True, the syllable is picked from the
+    precomputed syllable_tables() with a single random draw, if available.
+    '''
+    if tables:
+        table = syllable_tables(vowels, consonants)[syllable_type]
+        if table is not None:
+            return table[secrets.randbelow(len(table))]
     v = lambda: secrets.choice(vowels)
     c = lambda: secrets.choice(consonants)
     return SYLLABLE_PATTERNS[syllable_type](v, c)
 
 
-def generate_word(num_syllables, vowels, consonants):
+def generate_word(num_syllables, vowels, consonants, tables=False,
+                  markov=False, syllable_types=None):
     '''
     Generate a word, consisting of any number of syllabes as defined in
-    num_syllables.
+    num_syllables. With markov=True, each character is drawn from the
+    transition_tables() entry of its predecessor and the class of its
+    successor. The syllable types are drawn with weighted_random() unless
+    given in syllable_types.
     '''
     if num_syllables <= 0:
         raise ValueError('Number of syllables must be positive.')
-
-    return ''.join(generate_syllable(weighted_random(len(SYLLABLE_PATTERNS)),
-                                     vowels, consonants)
-                   for _ in range(num_syllables))
-
-
-def generate_wordlist(num_words, num_syllables, vowels, consonants):
+    if syllable_types is None:
+        syllable_types = [weighted_random(len(SYLLABLE_PATTERNS))
+                          for _ in range(num_syllables)]
+
+    if markov:
+        transitions = transition_tables(vowels, consonants)
+        template = ''.join(syllable_template(t) for t in syllable_types)
+        word = []
+        prev = None
+        for i, cls in enumerate(template):
+            follow = template[i + 1] if i + 1 < len(template) else None
+            table = transitions[prev][cls, follow]
+            prev = table[secrets.randbelow(len(table))]
+            word.append(prev)
+        return ''.join(word)
+
+    return ''.join(generate_syllable(syllable_type, vowels, consonants, tables)
+                   for syllable_type in syllable_types)
+
+
+def generate_wordlist(num_words, num_syllables, vowels, consonants,
+                      tables=False, markov=False, syllable_types=None):
     '''
-    Generate a list of words.
+    Generate a list of words. syllable_types optionally holds a list of
+    syllable types per word, see generate_syllable_types().
     '''
     if num_words <= 0:
         raise ValueError('Number of words must be positive.')
-    return [generate_word(num_syllables, vowels, consonants)
-            for _ in range(num_words)]
+    if syllable_types is None:
+        syllable_types = [None] * num_words
+    return [generate_word(num_syllables, vowels, consonants, tables, markov,
+                          syllable_types[i])
+            for i in range(num_words)]
 
 
 def randomized_delimiter_join(words, delimiters):
@@ -250,29 +763,36 @@ def get_default_options():
     options.delimiters = DEFAULT_DELIMITERS
     options.strict = False
     options.length = None
+    options.max_length = None
+    options.exact_length = None
     options.entropy = False
+    options.tables = False
+    options.markov = False
+    options.kdf = None
+    options.kdf_params = None
+    options.redact = False
+    options.workers = None
+    options.export = None
     return options
 
 
 def generate_passphrase(options):
     '''
     Generate a single passphrase, with all options applied
-    (except options.count).
+    (except options.count). The options tables, markov, max_length and
+    exact_length may be missing from hand-built namespaces and default to off.
     '''
-    n = 0
-    while True:
-        n += 1
-        wordlist = generate_wordlist(
-                options.words, options.syllables,
-                options.vowels, options.consonants)
+    if _length_bounds(options) is not None:
+        syllable_types = generate_syllable_types(options)
+    else:
+        syllable_types = None
+    wordlist = generate_wordlist(
+            options.words, options.syllables,
+            options.vowels, options.consonants,
+            getattr(options, 'tables', False), getattr(options, 'markov', False),
+            syllable_types)
 
-        passphrase = randomized_delimiter_join(wordlist, options.delimiters)
-        if options.length is None:
-            break
-        if len(passphrase) >= options.length:
-            break
-        if n >= 1000:
-            raise ValueError('Couldn\'t generate passphrase with specified minimum length.')
+    passphrase = randomized_delimiter_join(wordlist, options.delimiters)
 
     # add digits
     if options.allnums:
@@ -304,21 +824,348 @@ def generate_passphrase(options):
     return passphrase
 
 
+def _chunk_sizes(count, chunk_size):
+    '''
+    Yield the sizes of the chunks needed for count passphrases, endlessly
+    if count is None.
+    '''
+    if chunk_size <= 0:
+        raise ValueError('Chunk size must be positive.')
+    while count is None or count > 0:
+        size = chunk_size if count is None else min(chunk_size, count)
+        if count is not None:
+            count -= size
+        yield size
+
+
+def _generate_chunk(options, size):
+    return [generate_passphrase(options) for _ in range(size)]
+
+
+def iter_passphrases(options, count=None, chunk_size=PASSPHRASE_CHUNK_SIZE):
+    '''
+    Lazily yield count passphrases, or an unlimited stream if count is None.
+    Passphrases are generated in chunks of chunk_size.
+    '''
+    for size in _chunk_sizes(count, chunk_size):
+        yield from _generate_chunk(options, size)
+
+
+async def aiter_passphrases(options, count=None,
+                            chunk_size=PASSPHRASE_CHUNK_SIZE,
+                            prefetch=2, executor=None):
+    '''
+    Asynchronously yield count passphrases, or an unlimited stream if count
+    is None. Chunks of chunk_size passphrases are generated in executor
+    (the event loop's default executor if None), with at most prefetch
+    chunks scheduled ahead of the consumer.
+    '''
+    if prefetch <= 0:
+        raise ValueError('Prefetch must be positive.')
+    loop = asyncio.get_running_loop()
+    sizes = _chunk_sizes(count, chunk_size)
+    pending = collections.deque()
+    try:
+        while True:
+            for size in itertools.islice(sizes, prefetch - len(pending)):
+                pending.append(loop.run_in_executor(
+                        executor, _generate_chunk, options, size))
+            if not pending:
+                return
+            for passphrase in await pending.popleft():
+                yield passphrase
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def kdf_hash(passphrase, salt, kdf, params):
+    '''
+    Hash the passphrase with the key derivation function kdf ('scrypt' or
+    'pbkdf2') and its keyword parameters. Return the hash as a PHC string,
+    with salt and hash in unpadded base64:
+    '$scrypt$ln=<log2(n)>,r=<r>,p=<p>$<salt>$<hash>' or
+    '$pbkdf2-<hash_name>$i=<iterations>$<salt>$<hash>'.
+    Unless given, scrypt's maxmem is derived from n, r and p, as its default
+    of 32 MiB is already exceeded by n=32768, r=8.
+    '''
+    if kdf == 'scrypt':
+        params = dict(params)
+        # 128 * r bytes per block, n + 2 blocks of scratch space and p blocks
+        # of input, plus some slack
+        params.setdefault('maxmem', 128 * params['r'] * (params['n'] + params['p'] + 2)
+                          + (1 << 20))
+        key = hashlib.scrypt(passphrase.encode(), salt=salt, **params)
+        ident = (f'scrypt$ln={params["n"].bit_length() - 1},'
+                 + f'r={params["r"]},p={params["p"]}')
+    elif kdf == 'pbkdf2':
+        key = hashlib.pbkdf2_hmac(password=passphrase.encode(), salt=salt,
+                                  **params)
+        ident = f'pbkdf2-{params["hash_name"]}$i={params["iterations"]}'
+    else:
+        raise ValueError(f'Unknown key derivation function: {kdf}.')
+    b64 = lambda b: base64.b64encode(b).decode().rstrip('=')
+    return f'${ident}${b64(salt)}${b64(key)}'
+
+
+def provision_passphrases(options, count=None, kdf='scrypt', kdf_params=None,
+                          redact=False, workers=None, queue_size=None):
+    '''
+    Generate passphrases and hash them in a pipeline of overlapping stages:
+    a thread generates passphrases into a bounded queue, a pool of worker
+    processes hashes them with kdf_hash(), and the records
+    (id, passphrase, hash) are yielded in order. With redact=True the
+    passphrase of each record is None and is not kept after its hash has
+    been requested.
+    kdf_params override KDF_DEFAULTS. workers defaults to the number of CPUs
+    and queue_size, the number of passphrases queued for as well as in the
+    pool, to twice the number of workers. Worker processes are spawned, not
+    forked, as the generating thread is already running. Spawned processes
+    import the caller's main module, so scripts must call this from within an
+    'if __name__ == "__main__":' block, otherwise the pool breaks with
+    BrokenProcessPool.
+    '''
+    if kdf not in KDF_DEFAULTS:
+        raise ValueError(f'Unknown key derivation function: {kdf}.')
+    params = dict(KDF_DEFAULTS[kdf])
+    params.update(kdf_params or {})
+    workers = workers or os.cpu_count() or 1
+    queue_size = queue_size or 2 * workers
+    plaintexts = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                plaintexts.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        # any error ends the stream and is raised again by the consumer
+        try:
+            for record in enumerate(iter_passphrases(options, count, 1)):
+                if not put(record):
+                    return
+        except BaseException as e:
+            put(e)
+            return
+        put(None)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    # the producer thread is already running, so don't fork
+    pool = ProcessPoolExecutor(max_workers=workers,
+                               mp_context=multiprocessing.get_context('spawn'))
+    pending = collections.deque()
+    try:
+        while True:
+            record = plaintexts.get()
+            if record is None:
+                break
+            if isinstance(record, BaseException):
+                raise record
+            i, passphrase = record
+            future = pool.submit(kdf_hash, passphrase, secrets.token_bytes(16),
+                                 kdf, params)
+            pending.append((i, None if redact else passphrase, future))
+            del record, passphrase
+            if len(pending) >= queue_size:
+                i, passphrase, future = pending.popleft()
+                yield i, passphrase, future.result()
+        while pending:
+            i, passphrase, future = pending.popleft()
+            yield i, passphrase, future.result()
+    finally:
+        stop.set()
+        for _, _, future in pending:
+            future.cancel()
+        pool.shutdown()
+        producer.join()
+
+
+def max_passphrase_bytes(options):
+    '''
+    Return the maximum size in bytes of a UTF-8 encoded passphrase generated
+    with the given options, based on the longest passphrase which the
+    syllable_length_classes() can form within the length constraints.
+    '''
+    num_syllables = options.words * options.syllables
+    lo, hi = _length_bounds(options) or (0, math.inf)
+    classes = syllable_length_classes()
+    longest = min(hi - _delimiter_count(options), num_syllables * classes[-1][0])
+    shortest = max(lo - _delimiter_count(options), num_syllables * classes[0][0])
+    while (longest >= shortest
+           and not _class_count(num_syllables, longest, classes)):
+        longest -= 1
+    if longest < shortest:
+        raise ValueError('No passphrase can satisfy the specified length constraints.')
+    pool = (options.vowels + options.consonants + options.numerics
+            + options.delimiters)
+    char_bytes = max(len(ch.encode()) for c in pool for ch in (c, c.upper()))
+    return (longest + _delimiter_count(options)) * char_bytes
+
+
+def export_passphrases(path, options, count=None):
+    '''
+    Write count (default: options.count) passphrases to a binary file with
+    fixed size records through a memory map, see EXPORT_HEADER. The metadata
+    holds the options and their entropy_bits(). Use PassphraseFile to read it.
+    The number of records is only written once all of them are, and the file
+    is removed if generating them fails after it has been opened.
+    '''
+    if count is None:
+        count = options.count
+    width = max_passphrase_bytes(options)
+    if width > 0xFFFF:
+        raise ValueError('Passphrases are too long for the export format.')
+    record_size = EXPORT_RECORD_PREFIX.size + width
+    bits = entropy_bits(options)
+    metadata = json.dumps({
+            'options': {k: v for k, v in vars(options).items()
+                        if isinstance(v, (str, int, float, bool, type(None)))},
+            'entropy_bits': None if math.isinf(bits) else bits,
+        }).encode()
+    header_size = -(-(EXPORT_HEADER.size + len(metadata)) // 8) * 8
+
+    with open(path, 'w+b') as f:
+        try:
+            f.truncate(header_size + count * record_size)
+            with mmap.mmap(f.fileno(), 0) as mm:
+                EXPORT_HEADER.pack_into(mm, 0, EXPORT_MAGIC, header_size,
+                                        record_size, 0)
+                mm[EXPORT_HEADER.size:EXPORT_HEADER.size + len(metadata)] = metadata
+                offset = header_size
+                for passphrase in iter_passphrases(options, count):
+                    data = passphrase.encode()
+                    EXPORT_RECORD_PREFIX.pack_into(mm, offset, len(data))
+                    start = offset + EXPORT_RECORD_PREFIX.size
+                    mm[start:start + len(data)] = data
+                    offset += record_size
+                EXPORT_HEADER.pack_into(mm, 0, EXPORT_MAGIC, header_size,
+                                        record_size, count)
+                mm.flush()
+        except BaseException:
+            # only remove the file once it has been truncated by us
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            raise
+
+
+class PassphraseFile:
+    '''
+    Random access to a file written by export_passphrases(), through a read
+    only memory map. Indexing returns the UTF-8 encoded passphrase as a
+    memoryview into the map, slicing a list of them; nothing is copied.
+    The options and entropy_bits of the export are available as attributes.
+    '''
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+            try:
+                self._read_header(path)
+            except BaseException:
+                self._mmap.close()
+                raise
+        except BaseException:
+            self._file.close()
+            raise
+        self._view = memoryview(self._mmap)
+
+    def _read_header(self, path):
+        if len(self._mmap) < EXPORT_HEADER.size:
+            raise ValueError(f'{path} is not an apwgen export file.')
+        magic, self.header_size, self.record_size, self.count = \
+            EXPORT_HEADER.unpack_from(self._mmap)
+        if magic != EXPORT_MAGIC:
+            raise ValueError(f'{path} is not an apwgen export file.')
+        if (self.header_size < EXPORT_HEADER.size
+                or self.record_size < EXPORT_RECORD_PREFIX.size
+                or len(self._mmap) < self.header_size + self.count * self.record_size):
+            raise ValueError(f'{path} is truncated or corrupt.')
+        metadata = json.loads(
+                self._mmap[EXPORT_HEADER.size:self.header_size].rstrip(b'\x00'))
+        self.options = SimpleNamespace(**metadata['options'])
+        self.entropy_bits = metadata['entropy_bits']
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.count))]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('Passphrase index out of range.')
+        offset = self.header_size + index * self.record_size
+        (length,) = EXPORT_RECORD_PREFIX.unpack_from(self._mmap, offset)
+        start = offset + EXPORT_RECORD_PREFIX.size
+        return self._view[start:start + length]
+
+    def close(self):
+        '''
+        Close the file. While memoryviews returned by indexing are still in
+        use, the memory map stays valid until the last of them is released.
+        '''
+        try:
+            self._view.release()
+            self._mmap.close()
+        except BufferError:
+            pass
+        finally:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 def emit_passphrases(options):
     '''
-    Output any number of passphrases to the terminal.
+    Output any number of passphrases to the terminal. With options.kdf, output
+    tab separated records of id, passphrase (or "*" with options.redact) and
+    hash instead. With options.export, write them to that file with
+    export_passphrases().
     '''
     err = 0
-    for i in range(options.count):
+    export = getattr(options, 'export', None)
+    kdf = getattr(options, 'kdf', None)
+    if export is not None:
         try:
-            print(generate_passphrase(options))
-        except ValueError as e:
-            if options.count == 1:
-                print(f" {e}", file=sys.stderr)
-                break
-            else:
-                err += 1
-                last_err = e
+            export_passphrases(export, options)
+        except (ValueError, OSError) as e:
+            print(f" {e}", file=sys.stderr)
+    elif kdf is not None:
+        try:
+            for i, passphrase, hashed in provision_passphrases(
+                    options, options.count, kdf,
+                    getattr(options, 'kdf_params', None),
+                    getattr(options, 'redact', False),
+                    getattr(options, 'workers', None)):
+                print(f'{i}\t{"*" if passphrase is None else passphrase}\t{hashed}')
+        except (ValueError, TypeError, BrokenProcessPool) as e:
+            print(f" {e}", file=sys.stderr)
+    else:
+        for i in range(options.count):
+            try:
+                print(generate_passphrase(options))
+            except ValueError as e:
+                if options.count == 1:
+                    print(f" {e}", file=sys.stderr)
+                    break
+                else:
+                    err += 1
+                    last_err = e
     if err > 0:
         print(f" Passphrase generation failed for {err} passphrases. \n"
               + " Check your options and retry. Last error was: \n"
@@ -326,7 +1173,7 @@ def emit_passphrases(options):
     if options.entropy:
         bits = entropy_bits(options)
         if math.isinf(bits):
-            print("Estimated entropy: n/a (minimum length is unreachable)")
+            print("Estimated entropy: n/a (length constraints are unreachable)")
         else:
             print(f"Estimated entropy: {bits:.1f} bits")
 
@@ -376,6 +1223,12 @@ class ApwgenArgumentParser(argparse.ArgumentParser):
                 '-l', '--length',
                 type=int, default=None,
                 help='Ensure a minimum password length after all modifiers were applied.')
+        self.add_argument(
+                '--max-length', type=int, default=None,
+                help='Ensure a maximum password length.')
+        self.add_argument(
+                '--exact-length', type=int, default=None,
+                help='Generate passwords of exactly this length.')
         self.add_argument(
                 '-a', '--allnums',
                 action='store_true',
@@ -402,11 +1255,60 @@ class ApwgenArgumentParser(argparse.ArgumentParser):
                 '--strict',
                 action='store_true',
                 help='Ensure all modifiers (upper case, digits) could be applied. ')
+        self.add_argument(
+                '--tables',
+                action='store_true',
+                help='Pick syllables from precomputed lookup tables. Faster '
+                + 'for large counts, same distribution. Not available with '
+                + '-m/--markov.')
+        self.add_argument(
+                '-m', '--markov',
+                action='store_true',
+                help='Draw characters from a phoneme transition model which '
+                + 'avoids hard to pronounce letter combinations.')
+        self.add_argument(
+                '--hash', dest='kdf', choices=sorted(KDF_DEFAULTS),
+                default=None,
+                help='Hash each passphrase with the given key derivation '
+                + 'function, using all CPU cores. Outputs tab separated '
+                + 'id, passphrase and hash.')
+        self.add_argument(
+                '--kdf-params', type=kdf_params_type, default=None,
+                help='Parameters for --hash as comma separated key=value '
+                + 'pairs, e.g. "n=32768,r=8,p=1" or "iterations=1000000".')
+        self.add_argument(
+                '--redact',
+                action='store_true',
+                help='Output "*" instead of the passphrase with --hash.')
+        self.add_argument(
+                '--workers', type=int, default=None,
+                help='Number of processes hashing passphrases with --hash. '
+                + 'Default: number of CPUs')
+        self.add_argument(
+                '--export', type=str, default=None, metavar='FILE',
+                help='Write the passphrases to FILE in a binary format with '
+                + 'fixed size records, for random access by index.')
         self.add_argument(
                 '-e', '--entropy',
                 action='store_true',
                 help='Show estimated entropy in bits after generating passphrases.')
 
+def kdf_params_type(value):
+    '''
+    Parse key derivation function parameters given as "key=value,...".
+    Numeric values are converted to int.
+    '''
+    params = {}
+    for pair in value.split(','):
+        key, sep, param = pair.partition('=')
+        if not sep or not key.strip():
+            raise argparse.ArgumentTypeError(
+                    f'Invalid parameter "{pair}", expected key=value.')
+        param = param.strip()
+        params[key.strip()] = int(param) if param.isdigit() else param
+    return params
+
+
 class ApwgenVersion(argparse.Action):
     '''
     Output version and author information (with --version)
@@ -444,6 +1346,27 @@ def validate_options(parser, options):
         parser.error(
                 'The number of uppercase letters (-u/--upper) cannot '
                 + 'be negative.')
+    if options.exact_length is not None and (
+            options.length is not None or options.max_length is not None):
+        parser.error(
+                'The exact length (--exact-length) cannot be combined with '
+                + '-l/--length or --max-length.')
+    if options.kdf is None and (options.kdf_params is not None
+                                or options.redact or options.workers is not None):
+        parser.error(
+                '--kdf-params, --redact and --workers require --hash.')
+    if options.export is not None and options.kdf is not None:
+        parser.error('--export cannot be combined with --hash.')
+    if options.tables and options.markov:
+        parser.error('--tables cannot be combined with -m/--markov.')
+    if options.workers is not None and options.workers <= 0:
+        parser.error(
+                'The number of workers (--workers) must be greater than zero.')
+    if (options.length is not None and options.max_length is not None
+            and options.length > options.max_length):
+        parser.error(
+                'The minimum length (-l/--length) must not exceed the '
+                + 'maximum length (--max-length).')
 
 
 def main(argv=None):
@@ -1,5 +1,8 @@
 import unittest
 import subprocess
+import os
+import tempfile
+import apwgen
 
 
 class TestApwgenCLI(unittest.TestCase):
@@ -60,15 +63,32 @@ class TestApwgenCLI(unittest.TestCase):
         passphrase = result.stdout.strip()
         self.assertGreaterEqual(len(passphrase), 20)
 
-    def test_length_reduces_entropy(self):
-        """Test that --length reduces entropy compared to unconstrained generation."""
+    def test_max_length_flag(self):
+        """Test that --max-length enforces a maximum passphrase length."""
+        result = subprocess.run(["python", "-m", "apwgen", "--max-length", "16", "-c", "20"],
+                                capture_output=True, text=True)
+        for passphrase in result.stdout.strip().splitlines():
+            self.assertLessEqual(len(passphrase), 16)
+
+    def test_exact_length_flag(self):
+        """Test that --exact-length generates passphrases of exactly that length."""
+        result = subprocess.run(["python", "-m", "apwgen", "--exact-length", "21", "-c", "20"],
+                                capture_output=True, text=True)
+        lines = result.stdout.strip().splitlines()
+        self.assertEqual(len(lines), 20)
+        for passphrase in lines:
+            self.assertEqual(len(passphrase), 21)
+
+    def test_length_constraints_entropy(self):
+        """Test that a minimum length raises and a maximum length lowers the entropy."""
         def get_entropy(extra_args):
             result = subprocess.run(["python", "-m", "apwgen", "-e"] + extra_args,
                                     capture_output=True, text=True)
             for line in result.stdout.splitlines():
                 if "Estimated entropy:" in line:
                     return float(line.split()[2])
-        self.assertGreater(get_entropy([]), get_entropy(["-l", "22"]))
+        self.assertLess(get_entropy([]), get_entropy(["-l", "22"]))
+        self.assertGreater(get_entropy([]), get_entropy(["--max-length", "16"]))
 
     def test_strict_flag_raises_on_impossible_request(self):
         """Test that --strict causes an error when digits can't be fully placed."""
@@ -91,6 +111,28 @@ class TestApwgenCLI(unittest.TestCase):
         passphrase = result.stdout.strip().replace("-", "")
         self.assertTrue(passphrase.isalpha())
 
+    def test_hash_flag(self):
+        """Test that --hash outputs id, redacted passphrase and hash per line."""
+        result = subprocess.run(["python", "-m", "apwgen", "--hash", "pbkdf2", "--kdf-params",
+                                 "iterations=1000", "--redact", "-c", "4"],
+                                capture_output=True, text=True)
+        lines = result.stdout.strip().splitlines()
+        self.assertEqual(len(lines), 4)
+        for i, line in enumerate(lines):
+            self.assertEqual(line.split("\t")[:2], [str(i), "*"])
+            self.assertTrue(line.split("\t")[2].startswith("$pbkdf2-sha256$i=1000$"))
+
+    def test_export_flag(self):
+        """Test that --export writes a file readable with PassphraseFile."""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "export.bin")
+            result = subprocess.run(["python", "-m", "apwgen", "--export", path, "-c", "10"],
+                                    capture_output=True, text=True)
+            self.assertEqual(result.stdout, "")
+            with apwgen.PassphraseFile(path) as exported:
+                self.assertEqual(len(exported), 10)
+                self.assertEqual(exported.options.count, 10)
+
     def test_custom_delimiter_pool(self):
         """Test that a multi-character delimiter pool uses only those characters."""
         result = subprocess.run(["python", "-m", "apwgen", "-w", "3", "-d", ":-/", "-c", "20", "-n0", "-u0"],
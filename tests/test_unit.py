@@ -21,6 +21,99 @@ class TestApwgenUnit(unittest.TestCase):
             for ch in syllable:
                 self.assertIn(ch, v + c)
 
+    def test_syllable_tables(self):
+        """Test that syllable tables enumerate each pattern completely, with multiplicity."""
+        v, c = "aae", "bcd"
+        tables = apwgen.syllable_tables(v, c)
+        self.assertEqual(len(tables), len(apwgen.SYLLABLE_PATTERNS))
+        for syllable_type, (nc, nv) in enumerate(apwgen.SYLLABLE_STRUCTURES):
+            table = tables[syllable_type]
+            self.assertEqual(len(table), len(c) ** nc * len(v) ** nv)
+            template = apwgen.syllable_template(syllable_type)
+            for syllable in table:
+                self.assertEqual(len(syllable), len(template))
+                for ch, cls in zip(syllable, template):
+                    self.assertIn(ch, v if cls == "v" else c)
+        # 'a' appears twice in the vowel pool, so "ba" must be twice as likely as "be"
+        cv = tables[apwgen.SYLLABLE_STRUCTURES.index((1, 1))]
+        self.assertEqual(cv.count("ba"), 2 * cv.count("be"))
+
+    def test_syllable_tables_memory_cap(self):
+        """Test that oversized pools fall back to per-character generation."""
+        consonants = "".join(chr(0x100 + i) for i in range(300))
+        tables = apwgen.syllable_tables(apwgen.DEFAULT_VOWELS, consonants)
+        self.assertIsNone(tables[0])  # CVC: 300 * 6 * 300 entries
+        self.assertIsNotNone(tables[3])  # CV: 300 * 6 entries
+        syllable = apwgen.generate_syllable(0, apwgen.DEFAULT_VOWELS, consonants, tables=True)
+        self.assertEqual(len(syllable), 3)
+
+    def test_syllable_tables_cache_is_bounded(self):
+        """Test that tables are only kept for a limited number of pools."""
+        for i in range(apwgen.SYLLABLE_TABLE_CACHE_SIZE + 3):
+            apwgen.syllable_tables("ae", "bcd" + chr(0x100 + i))
+        self.assertLessEqual(apwgen.syllable_tables.cache_info().currsize,
+                             apwgen.SYLLABLE_TABLE_CACHE_SIZE)
+
+    def test_entropy_tables_cache_is_bounded(self):
+        """Test that entropy tables are only kept for a limited number of pools."""
+        options = apwgen.get_default_options()
+        for i in range(apwgen.ENTROPY_TABLE_CACHE_SIZE + 3):
+            options.consonants = "bcd" + chr(0x100 + i)
+            apwgen.entropy_bits(options)
+        for table in (apwgen._word_entropy_table, apwgen._passphrase_entropy_table,
+                      apwgen._placement_entropy):
+            self.assertLessEqual(table.cache_info().currsize, apwgen.ENTROPY_TABLE_CACHE_SIZE)
+
+    def test_generate_syllable_tables(self):
+        """Test that table-based generation returns syllables matching the pattern structure."""
+        v, c = apwgen.DEFAULT_VOWELS, apwgen.DEFAULT_CONSONANTS
+        for syllable_type, (nc, nv) in enumerate(apwgen.SYLLABLE_STRUCTURES):
+            syllable = apwgen.generate_syllable(syllable_type, v, c, tables=True)
+            self.assertIn(syllable, apwgen.syllable_tables(v, c)[syllable_type])
+
+    def test_markov_word_avoids_forbidden_bigrams(self):
+        """Test that words from the transition model only contain allowed bigrams."""
+        forbidden = {pair for pair, weight in apwgen.BIGRAM_WEIGHTS.items() if weight == 0}
+        consonants = apwgen.DEFAULT_CONSONANTS
+        for _ in range(2000):
+            word = apwgen.generate_word(3, apwgen.DEFAULT_VOWELS, consonants, markov=True)
+            for i in range(len(word) - 1):
+                pair = word[i:i + 2]
+                self.assertNotIn(pair, forbidden, f"Forbidden bigram in: {word}")
+                if pair[0] in consonants and pair[1] in consonants:
+                    self.assertIn(pair, apwgen.CONSONANT_CLUSTERS, f"Bad cluster in: {word}")
+
+    def test_markov_word_entropy(self):
+        """Compare the transition model entropy per word length against a brute-force enumeration."""
+        import itertools
+        import math
+        v, c = "aiy", "bjtr"
+        transitions = apwgen.transition_tables(v, c)
+        probs = apwgen.syllable_type_probabilities()
+        for num_syllables in (1, 2, 3):
+            expected = {}
+            for types in itertools.product(range(len(probs)), repeat=num_syllables):
+                p_types = math.prod(probs[t] for t in types)
+                template = "".join(apwgen.syllable_template(t) for t in types)
+                dist = {"": 1.0}
+                for i, cls in enumerate(template):
+                    follow = template[i + 1] if i + 1 < len(template) else None
+                    new_dist = {}
+                    for word, p in dist.items():
+                        table = transitions[word[-1] if word else None][cls, follow]
+                        for ch in table:
+                            key = word + ch
+                            new_dist[key] = new_dist.get(key, 0.0) + p / len(table)
+                    dist = new_dist
+                h_chars = -sum(p * math.log2(p) for p in dist.values())
+                m, e = expected.get(len(template), (0.0, 0.0))
+                expected[len(template)] = (m + p_types,
+                                           e + p_types * (-math.log2(p_types) + h_chars))
+            table = apwgen._word_entropy_table(num_syllables, v, c, True)
+            for length, (m, e, *_) in enumerate(table):
+                self.assertAlmostEqual(m, expected.get(length, (0.0, 0.0))[0])
+                self.assertAlmostEqual(e, expected.get(length, (0.0, 0.0))[1])
+
     def test_generate_word(self):
         """Test that generate_word generates a word within the valid length range."""
         word = apwgen.generate_word(2, apwgen.DEFAULT_VOWELS, apwgen.DEFAULT_CONSONANTS)
@@ -54,6 +147,24 @@ class TestApwgenUnit(unittest.TestCase):
         options = parser.parse_args(["-w", "0"])  # Invalid case
         with self.assertRaises(SystemExit):  # parser.error() calls sys.exit()
             apwgen.validate_options(parser, options)
+        for args in (["--exact-length", "20", "-l", "18"],
+                     ["-l", "24", "--max-length", "20"],
+                     ["--tables", "-m"]):
+            options = parser.parse_args(args)
+            with self.assertRaises(SystemExit):
+                apwgen.validate_options(parser, options)
+
+    def test_generate_passphrase_minimal_options(self):
+        """Test that options lacking the newer attributes still generate passphrases."""
+        from types import SimpleNamespace
+        options = SimpleNamespace(count=1, syllables=2, words=3, num_digits=1, allnums=False,
+                                  upper=1, vowels=apwgen.DEFAULT_VOWELS,
+                                  consonants=apwgen.DEFAULT_CONSONANTS,
+                                  numerics=apwgen.DEFAULT_NUMERICS,
+                                  delimiters=apwgen.DEFAULT_DELIMITERS, strict=False,
+                                  length=24, entropy=False)
+        self.assertGreaterEqual(len(apwgen.generate_passphrase(options)), 24)
+        self.assertGreater(apwgen.entropy_bits(options), 0)
 
     def test_get_lc_positions(self):
         challenges = [
@@ -89,6 +200,357 @@ class TestApwgenUnit(unittest.TestCase):
                 apwgen.get_possible_digit_positions(["aaaaa"]),
                 [4])
 
+    def test_entropy_bits_length_constraints(self):
+        """Compare the conditioned entropy against a brute-force enumeration of all type sequences."""
+        import itertools
+        import math
+        probs = apwgen.syllable_type_probabilities()
+        options = apwgen.get_default_options()
+        options.num_digits, options.upper = 0, 0
+        char_bits = {"v": math.log2(len(options.vowels)), "c": math.log2(len(options.consonants))}
+        for constraint, lo, hi in (("exact_length", 14, 14), ("max_length", 0, 16),
+                                   ("exact_length", 26, 26), ("length", 24, math.inf),
+                                   ("exact_length", 20, 20)):
+            accepted = []
+            for types in itertools.product(range(len(probs)), repeat=6):
+                template = "".join(apwgen.syllable_template(t) for t in types)
+                if lo <= len(template) + 2 <= hi:
+                    accepted.append((math.prod(probs[t] for t in types),
+                                     sum(char_bits[c] for c in template)))
+            p_accept = sum(p for p, _ in accepted)
+            expected = sum(p / p_accept * (-math.log2(p / p_accept) + h) for p, h in accepted)
+
+            options.length = options.max_length = options.exact_length = None
+            setattr(options, constraint, lo if constraint != "max_length" else hi)
+            self.assertAlmostEqual(apwgen.entropy_bits(options), expected, places=6)
+
+    def test_passphrase_length_pmf(self):
+        """Test that the length distribution sums up to one and has the expected support."""
+        options = apwgen.get_default_options()
+        pmf = apwgen._passphrase_length_pmf(options)
+        self.assertAlmostEqual(sum(pmf.values()), 1.0)
+        self.assertEqual(min(pmf), 6 * 2 + 2)
+        self.assertEqual(max(pmf), 6 * 4 + 2)
+        # the sampler's exact counts give the same distribution
+        table = apwgen.syllable_length_table(6)
+        for length, p in pmf.items():
+            self.assertAlmostEqual(p, (table[length - 1] - table[length - 2]) / table[-1])
+
+    def test_generate_syllable_types_exact_length(self):
+        """Test that constrained syllable types always reach the requested length."""
+        options = apwgen.get_default_options()
+        for exact_length in (14, 17, 20, 26):
+            options.exact_length = exact_length
+            for _ in range(200):
+                types = apwgen.generate_syllable_types(options)
+                self.assertEqual(len(types), options.words)
+                length = sum(sum(apwgen.SYLLABLE_STRUCTURES[t]) for word in types for t in word)
+                self.assertEqual(length + options.words - 1, exact_length)
+        options.exact_length = 13
+        with self.assertRaises(ValueError):
+            apwgen.generate_syllable_types(options)
+
+    def test_generate_syllable_types_distribution(self):
+        """Chi-square test that constrained syllable types match the conditioned distribution."""
+        import itertools
+        import math
+        probs = apwgen.syllable_type_probabilities()
+        # (syllables, constraint, value, number of sequences, critical value at p=0.001)
+        for syllables, constraint, value, num_expected, critical in (
+                (2, "max_length", 5, 12, 31.26),
+                (3, "exact_length", 9, 32, 61.10)):
+            options = apwgen.get_default_options()
+            options.words, options.syllables, options.delimiters = 1, syllables, ""
+            setattr(options, constraint, value)
+            lo, hi = apwgen._length_bounds(options)
+            expected = {}
+            for types in itertools.product(range(len(probs)), repeat=syllables):
+                if lo <= sum(sum(apwgen.SYLLABLE_STRUCTURES[t]) for t in types) <= hi:
+                    expected[types] = math.prod(probs[t] for t in types)
+            total = sum(expected.values())
+
+            num_samples = 20000
+            counts = {types: 0 for types in expected}
+            for _ in range(num_samples):
+                counts[tuple(apwgen.generate_syllable_types(options)[0])] += 1
+
+            chi2 = sum((counts[t] - p / total * num_samples) ** 2 / (p / total * num_samples)
+                       for t, p in expected.items())
+            self.assertEqual(len(expected), num_expected)
+            self.assertLess(chi2, critical, f"chi2={chi2:.2f}, counts={counts}")
+
+    def test_syllable_length_table_cache(self):
+        """Test that the length table is only built for binding constraints, with a bounded cache."""
+        options = apwgen.get_default_options()
+        options.words, options.syllables, options.length = 100, 10, 10
+        apwgen.syllable_length_table.cache_clear()
+        types = apwgen.generate_syllable_types(options)
+        self.assertEqual(sum(map(len, types)), 1000)
+        self.assertEqual(apwgen.syllable_length_table.cache_info().currsize, 0)
+        for num_syllables in range(1, apwgen.SYLLABLE_TABLE_CACHE_SIZE + 3):
+            table = apwgen.syllable_length_table(num_syllables)
+            self.assertEqual(table[-1], 25 ** num_syllables)
+        self.assertLessEqual(apwgen.syllable_length_table.cache_info().currsize,
+                             apwgen.SYLLABLE_TABLE_CACHE_SIZE)
+
+    def test_iter_passphrases(self):
+        """Test that iter_passphrases yields the requested number of passphrases lazily."""
+        import itertools
+        options = apwgen.get_default_options()
+        self.assertEqual(len(list(apwgen.iter_passphrases(options, 10, chunk_size=3))), 10)
+        endless = apwgen.iter_passphrases(options, chunk_size=4)
+        self.assertEqual(len(list(itertools.islice(endless, 25))), 25)
+
+    def test_aiter_passphrases(self):
+        """Test that aiter_passphrases yields passphrases and can be closed early."""
+        import asyncio
+        options = apwgen.get_default_options()
+
+        async def collect(count, limit):
+            result = []
+            stream = apwgen.aiter_passphrases(options, count, chunk_size=3, prefetch=2)
+            async for passphrase in stream:
+                result.append(passphrase)
+                if len(result) == limit:
+                    break
+            await stream.aclose()
+            return result
+
+        self.assertEqual(len(asyncio.run(collect(10, None))), 10)
+        self.assertEqual(len(asyncio.run(collect(None, 17))), 17)
+
+    def test_provision_passphrases(self):
+        """Test that the hashing pipeline yields ordered records with verifiable hashes."""
+        import base64
+        import hashlib
+        options = apwgen.get_default_options()
+        params = {"n": 16, "r": 8, "p": 1}
+        records = list(apwgen.provision_passphrases(options, 7, "scrypt", params,
+                                                    workers=2, queue_size=3))
+        self.assertEqual([i for i, _, _ in records], list(range(7)))
+        for _, passphrase, hashed in records:
+            _, kdf, encoded_params, salt, key = hashed.split("$")
+            self.assertEqual(kdf, "scrypt")
+            self.assertEqual(encoded_params, "ln=4,r=8,p=1")
+            salt = base64.b64decode(salt + "=" * (-len(salt) % 4))
+            key = base64.b64decode(key + "=" * (-len(key) % 4))
+            self.assertEqual(hashlib.scrypt(passphrase.encode(), salt=salt, n=16, r=8, p=1,
+                                            dklen=32), key)
+
+        redacted = list(apwgen.provision_passphrases(options, 3, "pbkdf2", {"iterations": 10},
+                                                     redact=True, workers=1))
+        self.assertEqual(len(redacted), 3)
+        self.assertTrue(all(passphrase is None for _, passphrase, _ in redacted))
+
+    def test_kdf_hash_scrypt_cost(self):
+        """Test that scrypt costs above the default memory limit can be hashed."""
+        import hashlib
+        params = {"n": 1 << 15, "r": 8, "p": 2, "dklen": 32}
+        hashed = apwgen.kdf_hash("passphrase", b"salt", "scrypt", params)
+        key = hashlib.scrypt(b"passphrase", salt=b"salt", maxmem=1 << 26, **params)
+        self.assertEqual(hashed, "$scrypt$ln=15,r=8,p=2$c2FsdA$"
+                         + apwgen.base64.b64encode(key).decode().rstrip("="))
+        self.assertNotIn("maxmem", params)
+        with self.assertRaises(ValueError):
+            apwgen.kdf_hash("passphrase", b"salt", "scrypt", dict(params, maxmem=1 << 20))
+
+    def test_provision_passphrases_generation_error(self):
+        """Test that any error while generating passphrases reaches the consumer."""
+        options = apwgen.get_default_options()
+        options.vowels = ""
+        records = apwgen.provision_passphrases(options, 3, "pbkdf2", {"iterations": 10},
+                                               workers=1)
+        with self.assertRaises(IndexError):
+            list(records)
+
+    def test_emit_passphrases_broken_pool(self):
+        """Test that a broken hashing pool is reported instead of raised."""
+        import io
+        from contextlib import redirect_stderr
+        from unittest import mock
+        options = apwgen.ApwgenArgumentParser().parse_args(["--hash", "scrypt"])
+
+        def broken(*args):
+            raise apwgen.BrokenProcessPool("terminated abruptly")
+            yield
+
+        stderr = io.StringIO()
+        with mock.patch.object(apwgen, "provision_passphrases", broken), \
+                redirect_stderr(stderr):
+            apwgen.emit_passphrases(options)
+        self.assertIn("terminated abruptly", stderr.getvalue())
+
+    def test_kdf_params_type(self):
+        """Test parsing of --kdf-params."""
+        self.assertEqual(apwgen.kdf_params_type("n=1024, r=8,hash_name=sha512"),
+                         {"n": 1024, "r": 8, "hash_name": "sha512"})
+        with self.assertRaises(apwgen.argparse.ArgumentTypeError):
+            apwgen.kdf_params_type("n")
+
+    def test_export_passphrases(self):
+        """Test that exported passphrases can be read back by index and slice."""
+        import tempfile
+        options = apwgen.get_default_options()
+        options.vowels = "aeiouyä"
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "export.bin")
+            apwgen.export_passphrases(path, options, 50)
+            with apwgen.PassphraseFile(path) as exported:
+                self.assertEqual(len(exported), 50)
+                self.assertEqual(exported.record_size, 2 + (4 * 6 + 2) * 2)
+                self.assertEqual(exported.options.vowels, "aeiouyä")
+                self.assertAlmostEqual(exported.entropy_bits, apwgen.entropy_bits(options))
+                passphrases = [bytes(view).decode() for view in exported[:]]
+                self.assertEqual(len(passphrases), 50)
+                for passphrase in passphrases:
+                    self.assertEqual(len(passphrase.split("-")), 3)
+                self.assertEqual(bytes(exported[-1]).decode(), passphrases[-1])
+                self.assertEqual([bytes(view).decode() for view in exported[10:20:3]],
+                                 passphrases[10:20:3])
+                with self.assertRaises(IndexError):
+                    exported[50]
+
+    def test_passphrase_file_close(self):
+        """Test that the file closes with views in use and errors in the block propagate."""
+        import tempfile
+        options = apwgen.get_default_options()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "export.bin")
+            apwgen.export_passphrases(path, options, 5)
+            with apwgen.PassphraseFile(path) as exported:
+                view = exported[2]
+            self.assertTrue(exported._file.closed)
+            self.assertEqual(len(bytes(view).split(b"-")), 3)
+            del view
+            with self.assertRaises(KeyError):
+                with apwgen.PassphraseFile(path) as exported:
+                    view = exported[2]
+                    raise KeyError("inside")
+            self.assertTrue(exported._file.closed)
+
+            with open(path, "rb") as f:
+                data = f.read()
+            for size in (0, 10, len(data) - 1):
+                with open(path, "wb") as f:
+                    f.write(data[:size])
+                with self.assertRaises(ValueError):
+                    apwgen.PassphraseFile(path)
+
+    def test_export_passphrases_failure(self):
+        """Test that a failed export doesn't leave a file behind."""
+        import tempfile
+        options = apwgen.get_default_options()
+        options.num_digits, options.strict = 6, True
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "export.bin")
+            with self.assertRaises(ValueError):
+                apwgen.export_passphrases(path, options, 5)
+            self.assertFalse(os.path.exists(path))
+
+    def test_export_passphrases_open_failure(self):
+        """Test that an existing file is kept if it can't be opened for the export."""
+        import tempfile
+        from unittest import mock
+        options = apwgen.get_default_options()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "export.bin")
+            with open(path, "wb") as f:
+                f.write(b"keep")
+            with mock.patch.object(apwgen, "open", create=True,
+                                   side_effect=PermissionError(path)):
+                with self.assertRaises(PermissionError):
+                    apwgen.export_passphrases(path, options, 5)
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), b"keep")
+
+    def test_max_passphrase_bytes(self):
+        """Test the record width for the default options and length constraints."""
+        options = apwgen.get_default_options()
+        self.assertEqual(apwgen.max_passphrase_bytes(options), 4 * 6 + 2)
+        options.max_length = 20
+        self.assertEqual(apwgen.max_passphrase_bytes(options), 20)
+
+    def _output_entropy(self, options):
+        """Return the entropy of (syllable types, passphrase) by enumerating every outcome."""
+        import itertools
+        import math
+        probs = apwgen.syllable_type_probabilities()
+        transitions = apwgen.transition_tables(options.vowels, options.consonants)
+        pools = {"v": options.vowels, "c": options.consonants}
+        outcomes = {}
+        num_syllables = options.words * options.syllables
+        for types in itertools.product(range(len(probs)), repeat=num_syllables):
+            p_types = math.prod(probs[t] for t in types)
+            templates = ["".join(apwgen.syllable_template(t)
+                                 for t in types[i:i + options.syllables])
+                         for i in range(0, num_syllables, options.syllables)]
+            word_dists = []
+            for template in templates:
+                dist = {"": 1.0}
+                for i, cls in enumerate(template):
+                    follow = template[i + 1] if i + 1 < len(template) else None
+                    new_dist = {}
+                    for word, p in dist.items():
+                        if options.markov:
+                            table = transitions[word[-1] if word else None][cls, follow]
+                        else:
+                            table = pools[cls]
+                        for ch in table:
+                            new_dist[word + ch] = new_dist.get(word + ch, 0.0) + p / len(table)
+                    dist = new_dist
+                word_dists.append(dist)
+            for combo in itertools.product(*(d.items() for d in word_dists)):
+                wordlist = [w for w, _ in combo]
+                p_letters = p_types * math.prod(p for _, p in combo)
+                passphrase = options.delimiters[:1].join(wordlist)
+                if options.allnums:
+                    eligible = apwgen.get_lc_positions(passphrase)
+                else:
+                    eligible = apwgen.get_possible_digit_positions(
+                            wordlist, 1 if options.delimiters else 0)
+                num_digits = min(options.num_digits, len(eligible))
+                for positions in itertools.combinations(eligible, num_digits):
+                    for digits in itertools.product(options.numerics, repeat=num_digits):
+                        chars = list(passphrase)
+                        for pos, digit in zip(positions, digits):
+                            chars[pos] = digit
+                        lowercase = [i for i, ch in enumerate(chars) if ch.isalpha()]
+                        upper = min(options.upper, len(lowercase))
+                        p = p_letters / math.comb(len(eligible), num_digits) \
+                            / len(options.numerics) ** num_digits \
+                            / math.comb(len(lowercase), upper)
+                        for upper_positions in itertools.combinations(lowercase, upper):
+                            output = chars[:]
+                            for pos in upper_positions:
+                                output[pos] = output[pos].upper()
+                            key = (types, "".join(output))
+                            outcomes[key] = outcomes.get(key, 0.0) + p
+        self.assertAlmostEqual(sum(outcomes.values()), 1.0)
+        return -sum(p * math.log2(p) for p in outcomes.values())
+
+    def test_placement_entropy_model(self):
+        """Compare entropy_bits() against the entropy of all generated outcomes."""
+        options = apwgen.get_default_options()
+        options.vowels, options.consonants, options.numerics = "ae", "bcd", "01"
+        for words, syllables, allnums, num_digits, upper in ((1, 2, True, 1, 1),
+                                                             (1, 2, True, 2, 0),
+                                                             (2, 1, False, 2, 1),
+                                                             (2, 1, True, 1, 2)):
+            options.words, options.syllables = words, syllables
+            options.allnums, options.num_digits, options.upper = allnums, num_digits, upper
+            self.assertAlmostEqual(apwgen.entropy_bits(options), self._output_entropy(options),
+                                   msg=f"{words} {syllables} {allnums} {num_digits} {upper}")
+
+    def test_placement_entropy_model_markov(self):
+        """Test that the transition model entropy with digits doesn't overstate the outcomes."""
+        options = apwgen.get_default_options()
+        options.vowels, options.consonants, options.numerics = "ae", "bt", "01"
+        options.words, options.syllables, options.markov = 1, 2, True
+        options.allnums, options.num_digits, options.upper = True, 1, 1
+        self.assertLessEqual(apwgen.entropy_bits(options), self._output_entropy(options) + 1e-9)
+        options.num_digits = 0
+        self.assertAlmostEqual(apwgen.entropy_bits(options), self._output_entropy(options))
+
     def test_weighted_random_distribution(self):
         """Chi-square test that weighted_random() matches its expected probability distribution."""
         import math